@@ -1,109 +1,476 @@
+import argparse
+import hashlib
+import json
 import os
+import random
 import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
-from typing import Iterable, Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from typing import Iterable, Iterator, Optional
+
+try:
+    import orjson
+except ImportError:  # optional, only makes parsing faster
+    orjson = None
 
 OSU_TOKEN_URL = "https://osu.ppy.sh/oauth/token"
 OSU_API_BASE = "https://osu.ppy.sh/api/v2"
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "osu-top-plays")
+
+# one session for everything so connections to osu.ppy.sh / beatconnect.io get reused
+SESSION = requests.Session()
+# ask for compressed JSON from the API; never send "Connection: close", that defeats pooling
+SESSION.headers.update({
+    "Accept-Encoding": "gzip, deflate",
+    "Connection": "keep-alive",
+    "User-Agent": "osu-top-plays-downloader/1.0",
+})
+_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=32,
+    # Retry-After is left to limited_request: with it on, urllib3 retries 429/503 itself and
+    # sleeps per thread before the shared RateLimiter ever sees the response
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 504),
+        allowed_methods=frozenset(["GET", "HEAD", "POST"]),
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    ),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+API_PAGE_WORKERS = 5
+DOWNLOAD_WORKERS = 8
+MAX_ATTEMPTS = 5
+
+
+class RateLimiter:
+    """Token bucket that also backs off when the server says we're over its limit."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+    def update(self, r: requests.Response) -> None:
+        retry_after = parse_retry_after(r)
+        if retry_after is not None:
+            self.pause(retry_after)
+            return
+
+        remaining = r.headers.get("X-RateLimit-Remaining")
+        if remaining is not None and remaining.isdigit() and int(remaining) == 0:
+            reset = r.headers.get("X-RateLimit-Reset", "")
+            try:
+                reset_at = float(reset)
+            except ValueError:
+                # osu! doesn't always send a reset, its window is one minute
+                reset_at = 60.0
+            # reset is either seconds-until or a unix timestamp
+            self.pause(reset_at - time.time() if reset_at > 1e9 else reset_at)
+
+
+def parse_retry_after(r: requests.Response) -> Optional[float]:
+    value = r.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+API_LIMITER = RateLimiter(rate=5, burst=API_PAGE_WORKERS)
+DOWNLOAD_LIMITER = RateLimiter(rate=5)
+
+
+def limited_request(limiter: RateLimiter, method: str, url: str, **kwargs) -> requests.Response:
+    # 429/503 are only retried here (the adapter ignores Retry-After), so the pause goes on
+    # the shared limiter and every worker waits it out together
+    for attempt in range(MAX_ATTEMPTS):
+        limiter.acquire()
+        r = SESSION.request(method, url, **kwargs)
+        limiter.update(r)
+        if r.status_code not in (429, 503) or attempt == MAX_ATTEMPTS - 1:
+            return r
+        r.close()
+        if parse_retry_after(r) is None:
+            limiter.pause(min(60, 2 ** attempt * 0.5))
+
+
+# characters windows doesn't allow in filenames, plus control chars
+_BAD_CHAR_TABLE = str.maketrans("", "", '<>:"/\\|?*' + "".join(chr(i) for i in range(32)))
+_WHITESPACE_RUN = re.compile(r"\s+")
+# anything the slow path would change: bad chars, whitespace runs, non-space whitespace, leading/trailing whitespace
+_NEEDS_CLEANUP = re.compile(r'[<>:"/\\|?*\x00-\x1F]|\s\s|[^\S ]|^\s|\s$')
 
 
 def sanitize_filename(name: str) -> str:
-    name = re.sub(r'[<>:"/\\|?*\x00-\x1F]', "", name)
-    name = re.sub(r"\s+", " ", name).strip()
-    return name[:180] if len(name) > 180 else name
+    # most titles are already fine, one scan and no new strings
+    if not _NEEDS_CLEANUP.search(name):
+        return name[:180]
 
+    name = name.translate(_BAD_CHAR_TABLE)
+    name = _WHITESPACE_RUN.sub(" ", name).strip()
+    return name[:180]
 
-def get_client_credentials_token(client_id: str, client_secret: str) -> str:
+
+def _token_cache_path(client_id: str) -> str:
+    # keyed by client id so switching credentials doesn't reuse someone else's token
+    key = hashlib.sha256(client_id.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, f"token-{key}.json")
+
+
+def load_cached_token(client_id: str) -> Optional[str]:
+    try:
+        with open(_token_cache_path(client_id), "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        if time.time() < cached["expires_at"]:
+            return cached["access_token"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def save_cached_token(client_id: str, token: str, expires_in: int) -> None:
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # token file is only readable by the current user
+        fd = os.open(_token_cache_path(client_id), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, "w", encoding="utf-8") as f:
+            # expire a minute early so we never send a token that's about to die
+            json.dump({"access_token": token, "expires_at": time.time() + expires_in - 60}, f)
+    except OSError:
+        pass
+
+
+def _use_token(token: str) -> None:
+    SESSION.headers["Authorization"] = f"Bearer {token}"
+
+
+# set once a token is requested, so a rejected cached token can be replaced mid-run
+_credentials: Optional[tuple[str, str]] = None
+_token_lock = threading.Lock()
+_replaced_tokens: dict[str, str] = {}
+
+
+def _request_new_token(client_id: str, client_secret: str) -> str:
     data = {
         "client_id": client_id,
         "client_secret": client_secret,
         "grant_type": "client_credentials",
         "scope": "public",
     }
-    r = requests.post(OSU_TOKEN_URL, data=data, timeout=30)
+    r = SESSION.post(OSU_TOKEN_URL, data=data, timeout=30)
     r.raise_for_status()
-    token = r.json().get("access_token")
+    body = r.json()
+    token = body.get("access_token")
     if not token:
         raise RuntimeError(f"No access_token in response: {r.text}")
+
+    save_cached_token(client_id, token, int(body.get("expires_in") or 86400))
+    _use_token(token)
     return token
 
 
-def osu_api_get(token: str, path: str, params: Optional[dict] = None) -> dict | list:
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept": "application/json",
-    }
-    r = requests.get(f"{OSU_API_BASE}{path}", headers=headers, params=params, timeout=30)
+def get_client_credentials_token(client_id: str, client_secret: str) -> str:
+    global _credentials
+    _credentials = (client_id, client_secret)
+
+    token = load_cached_token(client_id)
+    if token:
+        _use_token(token)
+        return token
+
+    return _request_new_token(client_id, client_secret)
+
+
+def refresh_rejected_token(token: str) -> Optional[str]:
+    # the api said 401: drop the cached token and get a new one (once, even with many workers)
+    with _token_lock:
+        if token in _replaced_tokens:
+            return _replaced_tokens[token]
+        if _credentials is None:
+            return None
+
+        client_id, client_secret = _credentials
+        try:
+            os.remove(_token_cache_path(client_id))
+        except OSError:
+            pass
+        new_token = _request_new_token(client_id, client_secret)
+        _replaced_tokens[token] = new_token
+        return new_token
+
+
+def loads_json(data: bytes) -> dict | list:
+    # parse the raw bytes directly, skips requests' charset guessing
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def osu_api_get_conditional(
+    token: str,
+    path: str,
+    params: Optional[dict] = None,
+    etag: Optional[str] = None
+) -> tuple[dict | list | None, Optional[str]]:
+    # returns (None, etag) when the server says our copy is still current
+    token = _replaced_tokens.get(token, token)
+    for attempt in range(2):
+        # Accept stays off the session so beatconnect downloads keep the default */*
+        headers = {"Accept": "application/json"}
+        # Authorization is normally already on the session; only set it if a different token is passed
+        if SESSION.headers.get("Authorization") != f"Bearer {token}":
+            headers["Authorization"] = f"Bearer {token}"
+        if etag:
+            headers["If-None-Match"] = etag
+        r = limited_request(
+            API_LIMITER, "GET", f"{OSU_API_BASE}{path}", headers=headers, params=params, timeout=30
+        )
+        if r.status_code != 401 or attempt:
+            break
+        new_token = refresh_rejected_token(token)
+        if new_token is None:
+            break
+        token = new_token
+
+    if r.status_code == 401 and _credentials is not None:
+        # still rejected, don't leave a bad token cached for the next run
+        try:
+            os.remove(_token_cache_path(_credentials[0]))
+        except OSError:
+            pass
+    if r.status_code == 304:
+        return None, etag
     r.raise_for_status()
-    return r.json()
+    return loads_json(r.content), r.headers.get("ETag")
 
 
-def fetch_osu_top_plays(
+def osu_api_get(token: str, path: str, params: Optional[dict] = None) -> dict | list:
+    return osu_api_get_conditional(token, path, params)[0]
+
+
+def _scores_cache_path(user_id: int, mode: str) -> str:
+    return os.path.join(CACHE_DIR, f"scores-{user_id}-{mode}.json")
+
+
+def load_scores_cache(user_id: int, mode: str) -> dict:
+    # {"<offset>:<limit>": {"etag": ..., "scores": [...]}, "score_ids": [score ids from the last run]}
+    try:
+        with open(_scores_cache_path(user_id, mode), "r", encoding="utf-8") as f:
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_scores_cache(user_id: int, mode: str, cache: dict) -> None:
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(_scores_cache_path(user_id, mode), "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+    except OSError:
+        pass
+
+
+def iter_osu_top_play_pages(
     token: str,
     user_id: int,
     mode: str,
     limit_total: int
-) -> list[dict]:
-    scores: list[dict] = []
-    offset = 0
+) -> Iterator[list[dict]]:
     page_size = 100
+    offsets = range(0, limit_total, page_size)
+    cache = load_scores_cache(user_id, mode)
 
-    while offset < limit_total:
+    def fetch_page(offset: int) -> list[dict]:
+        limit = min(page_size, limit_total - offset)
         params = {
             "mode": mode,
-            "limit": min(page_size, limit_total - offset),
+            "limit": limit,
             "offset": offset,
             "legacy_only": 0,
             "include_fails": 0,
         }
+        key = f"{offset}:{limit}"
+        cached = cache.get(key) or {}
+        batch, etag = osu_api_get_conditional(
+            token, f"/users/{user_id}/scores/best", params=params, etag=cached.get("etag")
+        )
+        if batch is None:
+            # 304, reuse what we stored last run
+            return cached.get("scores") or []
+
+        batch = batch if isinstance(batch, list) else []
+        if etag:
+            cache[key] = {"etag": etag, "scores": batch}
+        else:
+            cache.pop(key, None)
+        return batch
+
+    # offsets are known up front, so request all pages at once and hand each one
+    # back (in order) as soon as it's in
+    try:
+        with ThreadPoolExecutor(max_workers=API_PAGE_WORKERS) as ex:
+            for offset, batch in zip(offsets, ex.map(fetch_page, offsets)):
+                yield batch
+                # a short page means the user has no more scores past this one
+                if len(batch) < min(page_size, limit_total - offset):
+                    break
+    finally:
+        save_scores_cache(user_id, mode, cache)
 
-        batch = osu_api_get(token, f"/users/{user_id}/scores/best", params=params)
-
-        if not isinstance(batch, list) or not batch:
-            break
 
+def fetch_osu_top_plays(
+    token: str,
+    user_id: int,
+    mode: str,
+    limit_total: int
+) -> list[dict]:
+    scores: list[dict] = []
+    for batch in iter_osu_top_play_pages(token, user_id, mode, limit_total):
         scores.extend(batch)
-        offset += len(batch)
-        time.sleep(0.2)
-
     return scores
 
 
-def iter_beatmapsets_from_scores(scores: Iterable[dict]) -> list[tuple[int, str]]:
-    seen: set[int] = set()
-    result: list[tuple[int, str]] = []
-
-    for s in scores:
-        bms_id = None
-        title = None
+def score_beatmapset_id(s: dict) -> Optional[int]:
+    # nearly every score has beatmapset.id, so just try it and fall back on failure
+    try:
+        return int(s["beatmapset"]["id"])
+    except (KeyError, TypeError, ValueError):
+        try:
+            return int(s["beatmap"]["beatmapset_id"])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+
+def iter_beatmapsets_from_scores(
+    scores: Iterable[dict],
+    skip_ids: Iterable[int] = ()
+) -> list[tuple[int, str]]:
+    return beatmapsets_from_score_ids(((s, score_beatmapset_id(s)) for s in scores), skip_ids)
+
+
+def beatmapsets_from_score_ids(
+    scored: Iterable[tuple[dict, Optional[int]]],
+    skip_ids: Iterable[int] = ()
+) -> list[tuple[int, str]]:
+    # same as iter_beatmapsets_from_scores, for callers that already have each score's beatmapset id
+    # dicts keep insertion order, so this doubles as the ordered "seen" set
+    result: dict[int, str] = {}
+    # ids we already have (on disk / earlier pages) never get a tuple built at all
+    skip = skip_ids if isinstance(skip_ids, (set, frozenset)) else set(skip_ids)
+
+    for s, bms_id in scored:
+        # only build a title for beatmapsets we haven't seen yet
+        if bms_id is None or bms_id in result or bms_id in skip:
+            continue
 
+        title = ""
         beatmapset = s.get("beatmapset")
         if isinstance(beatmapset, dict):
-            bms_id = beatmapset.get("id")
-            artist = beatmapset.get("artist") or ""
-            t = beatmapset.get("title") or ""
-            title = f"{artist} - {t}".strip(" -")
-
-        if bms_id is None:
-            beatmap = s.get("beatmap")
-            if isinstance(beatmap, dict):
-                bms_id = beatmap.get("beatmapset_id")
-
-        if bms_id is None:
-            continue
-
-        bms_id = int(bms_id)
-        if bms_id in seen:
-            continue
-        seen.add(bms_id)
-
-        if not title:
-            title = f"beatmapset_{bms_id}"
-
-        result.append((bms_id, title))
-
-    return result
+            bms_get = beatmapset.get
+            artist = bms_get("artist") or ""
+            t = bms_get("title") or ""
+            if artist or t:
+                title = f"{artist} - {t}".strip(" -")
+
+        result[bms_id] = title or f"beatmapset_{bms_id}"
+
+    return list(result.items())
+
+
+# O_BINARY matters on windows, without it os.write translates newlines
+_OSZ_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+
+
+def existing_beatmapset_ids(out_dir: str) -> set[int]:
+    # one directory listing instead of a stat() per beatmapset
+    ids: set[int] = set()
+    with os.scandir(out_dir) as it:
+        for entry in it:
+            if not entry.name.endswith(".osz"):
+                continue
+            prefix = entry.name.split(" - ", 1)[0]
+            if prefix.isdigit():
+                ids.add(int(prefix))
+    return ids
+
+
+class _BodyReadError(Exception):
+    # the connection died while reading the .osz, as opposed to while connecting
+    pass
+
+
+def _stream_to_file(url: str, path: str) -> Optional[int]:
+    # returns bytes written, or None if beatconnect didn't give us a file
+    # don't send the osu! bearer token to beatconnect
+    with limited_request(
+        DOWNLOAD_LIMITER,
+        "GET",
+        url,
+        headers={"Authorization": None},
+        allow_redirects=True,
+        stream=True,
+        timeout=(10, 60),
+    ) as r:
+        if r.status_code != 200 or r.headers.get("Content-Length") == "0" \
+                or r.headers.get("Content-Type", "").startswith("text/"):
+            return None
+
+        written = 0
+        # chunks are already 64 KiB, so skip python's buffered writer and write to the fd
+        fd = os.open(path, _OSZ_OPEN_FLAGS, 0o644)
+        try:
+            try:
+                for chunk in r.iter_content(chunk_size=1 << 16):
+                    view = memoryview(chunk)
+                    while view:
+                        view = view[os.write(fd, view):]
+                    written += len(chunk)
+            # resets mid-stream show up as ChunkedEncodingError, read timeouts as ConnectionError.
+            # connect failures are raised by limited_request above and already retried by the adapter
+            except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError) as e:
+                raise _BodyReadError(e) from e
+            if hasattr(os, "posix_fadvise"):
+                # we never read these back, don't keep them in the page cache
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+    return written
 
 
 def download_beatconnect_osz(beatmapset_id: int, display_title: str) -> bool:
@@ -113,21 +480,53 @@ def download_beatconnect_osz(beatmapset_id: int, display_title: str) -> bool:
     safe_title = sanitize_filename(display_title)
     out_path = os.path.join(out_dir, f"{beatmapset_id} - {safe_title}.osz")
 
-    # skip if already exists
-    if os.path.exists(out_path):
-        print(f"[SKIP] {beatmapset_id} - {display_title}")
-        return True
-
     url = f"https://beatconnect.io/b/{beatmapset_id}?n=1"
+    # write to .part first so an interrupted download isn't mistaken for a finished one
+    part_path = out_path + ".part"
 
     try:
-        r = requests.get(url, allow_redirects=True, timeout=60)
-        if r.status_code != 200 or not r.content:
+        # a finished .part left over from an earlier run can just be renamed, HEAD to check its size.
+        # nothing to reuse otherwise, so go straight to the GET (dead ids fail on its status check)
+        if os.path.exists(part_path):
+            head = limited_request(
+                DOWNLOAD_LIMITER,
+                "HEAD",
+                url,
+                headers={"Authorization": None},
+                allow_redirects=True,
+                timeout=10,
+            )
+            if head.status_code == 404:
+                print(f"[FAIL] {beatmapset_id} - {display_title}")
+                return False
+            # some servers don't do HEAD at all, in that case just try the GET
+            expected_size = head.headers.get("Content-Length") if head.status_code == 200 else None
+            if expected_size and expected_size.isdigit() and int(expected_size) > 0 \
+                    and os.path.getsize(part_path) == int(expected_size):
+                os.replace(part_path, out_path)
+                print(f"[SKIP] {beatmapset_id} - {display_title}")
+                return True
+
+        # the connection dropping mid-file is common enough to be worth a few retries
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                written = _stream_to_file(url, part_path)
+                break
+            except _BodyReadError:
+                if attempt == MAX_ATTEMPTS - 1:
+                    raise
+                time.sleep(random.uniform(0.5, 2.0) * 2 ** attempt)
+
+        if written is None:
+            print(f"[FAIL] {beatmapset_id} - {display_title}")
+            return False
+
+        if written == 0:
+            os.remove(part_path)
             print(f"[FAIL] {beatmapset_id} - {display_title}")
             return False
 
-        with open(out_path, "wb") as f:
-            f.write(r.content)
+        os.replace(part_path, out_path)
 
         print(f"[OK]   {beatmapset_id} - {display_title}")
         return True
@@ -138,6 +537,14 @@ def download_beatconnect_osz(beatmapset_id: int, display_title: str) -> bool:
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Download the beatmapsets of your osu! top plays.")
+    parser.add_argument(
+        "--only-new",
+        action="store_true",
+        help="only consider top plays that weren't there on the last run",
+    )
+    args = parser.parse_args()
+
     print("=== osu! top plays downloader ===\n")
 
     user_id = int(input("osu! user id: ").strip())
@@ -153,23 +560,83 @@ def main():
     print("\nRequesting OAuth token...")
     token = get_client_credentials_token(client_id, client_secret)
 
-    print(f"Fetching {mode} top plays...")
-    scores = fetch_osu_top_plays(token, user_id, mode, limit_total)
-    print(f"Fetched {len(scores)} scores.")
-
-    beatmapsets = iter_beatmapsets_from_scores(scores)
-    print(f"Unique beatmapsets: {len(beatmapsets)}\n")
-
+    # skip ones already downloaded into the current directory (and, later, ones queued from earlier pages)
+    out_dir = os.path.abspath(".")
+    on_disk_before = existing_beatmapset_ids(out_dir)
+    skip = set(on_disk_before)
+    counted_on_disk: set[int] = set()
+
+    # scores seen on earlier runs; None means no snapshot yet, which isn't the same as an empty one
+    prev_cache = load_scores_cache(user_id, mode)
+    prev_score_ids = set(prev_cache["score_ids"]) if isinstance(prev_cache.get("score_ids"), list) else None
+    # only filtered out with --only-new
+    old_score_ids = prev_score_ids if args.only_new else None
+
+    print(f"Fetching {mode} top plays...\n")
+    score_sets: list[tuple[int, int]] = []  # (score id, beatmapset id) for every fetched score
+    n_new_scores = 0
+    n_on_disk = 0
     failed: list[int] = []
-    for bms_id, title in beatmapsets:
-        if not download_beatconnect_osz(bms_id, title):
-            failed.append(bms_id)
-        time.sleep(0.2)
+    ex = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+    try:
+        futures = {}
+        # start downloading each page's maps while the later pages are still coming in
+        for page in iter_osu_top_play_pages(token, user_id, mode, limit_total):
+            # look up each score's beatmapset id once, everything below reuses it
+            scored = [(s, score_beatmapset_id(s)) for s in page]
+            for s, bms_id in scored:
+                if "id" in s and bms_id is not None:
+                    score_sets.append((s["id"], bms_id))
+            if old_score_ids is not None:
+                scored = [(s, b) for s, b in scored if s.get("id") not in old_score_ids]
+            n_new_scores += len(scored)
+
+            # sets already on disk, counted here since beatmapsets_from_score_ids drops them silently
+            page_on_disk = {b for _, b in scored if b in on_disk_before}
+            n_on_disk += len(page_on_disk - counted_on_disk)
+            counted_on_disk |= page_on_disk
+
+            beatmapsets = beatmapsets_from_score_ids(scored, skip)
+            skip.update(b for b, _ in beatmapsets)
+            # download in id order, keeps consecutive requests close together on beatconnect's side
+            beatmapsets.sort(key=lambda bt: bt[0])
+
+            for bms_id, title in beatmapsets:
+                futures[ex.submit(download_beatconnect_osz, bms_id, title)] = bms_id
+
+        if old_score_ids is not None and not n_new_scores:
+            print("No new plays since last run.")
+        else:
+            if old_score_ids is not None:
+                print(f"\nFetched {len(score_sets)} scores ({n_new_scores} new).")
+            else:
+                print(f"\nFetched {len(score_sets)} scores.")
+            print(f"Already downloaded: {n_on_disk}, beatmapsets to download: {len(futures)}\n")
+
+        for fut in as_completed(futures):
+            if not fut.result():
+                failed.append(futures[fut])
+    except BaseException:
+        # ctrl-c or a failed page fetch: drop the queued downloads instead of waiting on all of them
+        ex.shutdown(wait=False, cancel_futures=True)
+        raise
+    ex.shutdown()
+
+    # scores from earlier snapshots stay in it even once their .osz is imported or moved away.
+    # new ones are only added once their map is on disk, so failed or interrupted downloads
+    # are picked up again by the next --only-new run
+    on_disk = existing_beatmapset_ids(out_dir)
+    seen = prev_score_ids or set()
+    cache = load_scores_cache(user_id, mode)
+    cache["score_ids"] = [
+        score_id for score_id, bms_id in score_sets
+        if score_id in seen or bms_id in on_disk
+    ]
+    save_scores_cache(user_id, mode, cache)
 
     if failed:
         with open("failed_downloads.txt", "w", encoding="utf-8") as f:
-            for bms_id in failed:
-                f.write(f"{bms_id}\n")
+            f.write("\n".join(map(str, failed)) + "\n")
         print(f"\nFinished with {len(failed)} failures (see failed_downloads.txt)")
     else:
         print("\nFinished with no failures 🎉")